@@ -19,116 +19,201 @@
 ########################################################################
 
 import re
+import sys
 
 class Term (object):
     """A term, or tree node in the knowledge tree."""
 
+    __slots__ = ("name", "children", "parents", "_anc_cache")
+
     def __init__ (self, name):
         """Create the term."""
-        object.__init__ (self)
-        self.name = name
-        self.children = []
-        self.parents = []
-
-    def add_child (self, child):
-        """Add a child to this term."""
-        for exchild in self.children:
-            if exchild.name == child.name:
-                return False
-
-        self.children.append (child)
-
-        return child.add_parent (self)
+        # Names are interned so that the many name-keyed lookups can 
+        # usually compare by identity.
+        self.name = sys.intern (name)
+        self.children = {}
+        self.parents = {}
+        self._anc_cache = None
 
-    def add_parent (self, parent):
-        """Connect a parent to this child."""
-
-        for exparent in self.parents:
-            if exparent.name == parent.name:
-                return False
-
-        self.parents.append (parent)
-
-        obj.prune_tree ()
-
-        return True
+        # Never displace the term already known by this name.
+        name_index.setdefault (self.name, self)
 
     def remove_child (self, child):
         """Remove a child link."""
-        if type (child) == str:
-            child = obj.traverse (child)
+        if isinstance (child, str):
+            child = lookup (child)
             if child is None:
-                print "FATAL: Item does not exist."
+                print ("FATAL: Item does not exist.")
                 return
 
-        if child in self.children:
-            self.children.remove (child)
+        if self.children.get (child.name) is child:
+            del self.children[child.name]
 
     def remove_parent (self, parent):
         """Remove a parent link."""
-        if type (parent) == str:
-            parent = obj.traverse (parent)
+        if isinstance (parent, str):
+            parent = lookup (parent)
             if parent is None:
-                print "FATAL: Item does not exist."
+                print ("FATAL: Item does not exist.")
                 return
 
-        if parent in self.parents:
+        if self.parents.get (parent.name) is parent:
             parent.remove_child (self)
-            self.parents.remove (parent)
-
-    def traverse (self, name):
-        """Tree-search for the term object of name or alias name."""
-        if name in aliases.keys ():
-            name = aliases[name]
-
-        if self.name == name:
-            return self
-        else:
-            for child in self.children:
-                val = child.traverse (name)
-                if val is not None:
-                    return val
-            return None
+            del self.parents[parent.name]
+            self.forget_ancestry ()
 
     def get_name (self):
         """Retrieve this term's name."""
         return self.name
 
+    def rename (self, name):
+        """Change this term's name, re-keying the links and index 
+        entry that refer to it by name.
+        """
+        name = sys.intern (name)
+
+        if name_index.get (self.name) is self:
+            del name_index[self.name]
+        name_index[name] = self
+
+        for parent in self.parents.values ():
+            del parent.children[self.name]
+            parent.children[name] = self
+
+        for child in self.children.values ():
+            del child.parents[self.name]
+            child.parents[name] = self
+
+        self.name = name
+
+    def absorb (self, other):
+        """Move all of another term's links onto this term, leaving the 
+        other term unlinked.
+
+        Links that would make a term its own ancestor, as when a term
+        is merged with one of its own ancestors or descendants, are
+        dropped rather than moved.
+        """
+        for child in list (other.children.values ()):
+            child.remove_parent (other)
+            if child is not self and not self.has_ancestor (child):
+                link (self, child)
+
+        for parent in list (other.parents.values ()):
+            other.remove_parent (parent)
+            if parent is not self and not parent.has_ancestor (self):
+                link (parent, self)
+
+        if name_index.get (other.name) is other:
+            del name_index[other.name]
+
     def get_parents (self):
         """Retrieve this term's parents."""
-        return self.parents
-
-    def get_ancestry (self, alist=None):
-        """Get nested lists of all the ancestors of this term."""
-        if alist is None:
-            alist = []
-        for parent in self.parents:
-            anode = [parent.get_name ()]
-            anode.extend (parent.get_ancestry ())
-            alist.append (anode)
-        return alist
+        return list (self.parents.values ())
+
+    def get_ancestors (self):
+        """Get the set of all terms this term is a kind of.
+
+        This is this term's row of the transitive closure of the tree.
+        It is built from the parents' own sets and cached until the 
+        ancestry changes.
+        """
+        stack = [self]
+        on_stack = set (stack)
+
+        while stack:
+            term = stack[-1]
+
+            # A parent already on the stack could only be reached 
+            # through a cycle, so it is not pushed again.
+            pending = [parent for parent in term.parents.values ()
+                       if parent._anc_cache is None 
+                       and parent not in on_stack]
+            if pending:
+                stack.extend (pending)
+                on_stack.update (pending)
+            else:
+                ancestors = set (term.parents.values ())
+                for parent in term.parents.values ():
+                    if parent._anc_cache is not None:
+                        ancestors.update (parent._anc_cache)
+                term._anc_cache = frozenset (ancestors)
+                stack.pop ()
+                on_stack.discard (term)
+
+        return self._anc_cache
+
+    def has_ancestor (self, other):
+        """Return whether this term is, through any chain of parents, a 
+        kind of the other term.
+
+        This walks upwards and stops as soon as the other term turns up.
+        Cached ancestor sets met on the way are used, but new ones are 
+        not built.
+        """
+        seen = set ([self])
+        stack = [self]
+
+        while stack:
+            term = stack.pop ()
+            if term._anc_cache is not None:
+                if other in term._anc_cache:
+                    return True
+                continue
+
+            for parent in term.parents.values ():
+                if parent is other:
+                    return True
+                elif parent not in seen:
+                    seen.add (parent)
+                    stack.append (parent)
+
+        return False
+
+    def forget_ancestry (self):
+        """Drop the cached ancestry of this term and its descendants."""
+        stack = [self]
+
+        while stack:
+            term = stack.pop ()
+            # A term's ancestry is only ever cached after those of its 
+            # ancestors, so an uncached term has no cached descendants.
+            if term._anc_cache is not None:
+                term._anc_cache = None
+                stack.extend (term.children.values ())
 
     def print_tree (self, recur_depth=0):
         """Pretty-print the tree from this node."""
-        if self.name == "object":
-            print "OBJECT"
-        else:
-            print "|" + " " * recur_depth + "\\-" + self.name
+        stack = [(self, recur_depth)]
+
+        while stack:
+            term, depth = stack.pop ()
+            if term.name == "object":
+                print ("OBJECT")
+            else:
+                print ("|" + " " * depth + "\\-" + term.name)
 
-        for child in self.children:
-            child.print_tree (recur_depth + 1)
+            for child in reversed (list (term.children.values ())):
+                stack.append ((child, depth + 1))
 
-    def save_tree (self, file, in_list=[]):
-        """Recursively save this node's subtree into the file."""
-        for parent in self.parents:
-            if (self, parent) not in in_list:
-                print >> file, self.name, "is a kind of", parent.get_name ()
-                in_list.append ((self, parent))
+    def save_tree (self, file):
+        """Save this node's subtree into the file."""
+        seen = set ()
+        lines = []
+        stack = [self]
 
-        for child in self.children:
-            in_list = child.save_tree (file, in_list)
+        while stack:
+            term = stack.pop ()
+            if term in seen:
+                continue
+            seen.add (term)
 
-        return in_list
+            for parent in term.parents.values ():
+                lines.append (term.name + " is a kind of " + parent.name + "\n")
+
+            stack.extend (reversed (list (term.children.values ())))
+
+        file.write ("".join (lines))
 
     def prune_tree (self):
         """Walk down the tree from this point, removing all redundant 
@@ -139,92 +224,148 @@ class Term (object):
         for example, if an object Foo has ancestries Bar->Baz->object 
         and Baz->object, the latter will be pruned as it is replicated 
         more specifically in the former.
-        """
-
-        for parent1 in self.get_ancestry ():
-            for parent2 in self.get_ancestry ():
-                while len (parent2) > 1:
-                    if parent1 in parent2:
-                        self.remove_parent (parent1[0])
-                    parent2 = parent2[1]
 
-        for child in self.children:
-            child.prune_tree ()
-
-    def update_names (self):
-        """Walk down the tree from this point, replacing all aliases
-        with their true names.
+        Run from the root, this is a transitive reduction of the whole 
+        tree.  Linking a term to a new parent can only make links 
+        redundant in that term's own subtree, so only that subtree 
+        needs pruning afterwards.
         """
 
-        if self.name in aliases.keys ():
-            self.name = aliases[self.name]
+        seen = set ()
+        stack = [self]
 
-        for child in self.children:
-            child.update_names ()
+        while stack:
+            term = stack.pop ()
+            if term in seen:
+                continue
+            seen.add (term)
 
-    def list_reduce (self, list=[]):
-        """Reduce the tree starting from this root into a list."""
-        if self not in list:
-            list.append (self)
+            # Any parent that is also an ancestor of another parent is 
+            # already reached through that parent.
+            indirect = set ()
+            for parent in term.parents.values ():
+                indirect.update (parent.get_ancestors ())
 
-        for child in self.children:
-            list = child.list_reduce (list)
+            for parent in list (term.parents.values ()):
+                if parent in indirect:
+                    term.remove_parent (parent)
 
-        return list
+            stack.extend (term.children.values ())
 
+name_index = {}
 obj = Term("object")
 aliases = {}
 
+# Terms that have gained parents since the tree was last pruned.
+unpruned = set ()
+
+def lookup (name):
+    """Find the term object of name or alias name."""
+    return name_index.get (aliases.get (name, name))
+
+def link (parent, child):
+    """Make child a kind of parent, returning False if it already is 
+    directly.
+
+    The link is recorded on both terms at once, and the child is left 
+    for prune_pending to check for links the new one makes redundant.
+    """
+    if child.name in parent.children:
+        return False
+
+    parent.children[child.name] = child
+    child.parents[parent.name] = parent
+    child.forget_ancestry ()
+    unpruned.add (child)
+
+    return True
+
 def add_kind_of (x, y):
-    """Create an "x is kind of y" relationship."""
-    
-    newobj = obj.traverse (x)
+    """Create an "x is kind of y" relationship.
+
+    Relationships that would make a term a kind of itself, directly or 
+    through its ancestors, are refused.
+    """
+
+    # Work with real names throughout, so that a term created for an 
+    # alias whose target does not exist yet is created under the 
+    # target's name and found again under it.
+    x = resolve_alias (x)
+    y = resolve_alias (y)
+
+    if x == y:
+        print ("FATAL:", x, "cannot be a kind of itself.")
+        return
+
+    newobj = name_index.get (x)
 
     if newobj is None:
         newobj = Term (x)
 
-    superobj = obj.traverse (y)
+    superobj = name_index.get (y)
 
     if superobj is None:
-        print "WARNING: Parent object", y, "does not exist."
-        print "Creating new parent object and linking to object."
+        print ("WARNING: Parent object", y, "does not exist.")
+        print ("Creating new parent object and linking to object.")
 
         add_kind_of (y, "object")
 
-        superobj = obj.traverse (y)
+        superobj = name_index[y]
+
+    if superobj.has_ancestor (newobj):
+        print ("FATAL:", y, "is already a kind of", x + ".")
+        return
 
-    superobj.add_child (newobj)
+    link (superobj, newobj)
+
+def prune_pending ():
+    """Prune the subtrees of all terms that have gained parents since 
+    the last prune.
+    """
+    while unpruned:
+        unpruned.pop ().prune_tree ()
 
 def is_kind_of (x, y):
     """Return whether x is a kind of y."""
-    parentobj = obj.traverse (y)
+    parentobj = lookup (y)
+    childobj = lookup (x)
 
     if parentobj is None:
-        print "FATAL: Parent object", y, "does not exist."
-    elif parentobj.traverse (x) is None:
+        print ("FATAL: Parent object", y, "does not exist.")
+    elif childobj is None:
         return False
     else:
-        return True
+        return childobj is parentobj or childobj.has_ancestor (parentobj)
 
-def what_is (item, recur_depth=0):
+def what_is (item):
     """Answer a "what is X?" question by printing knowledge about the 
     kind of object X is.
+
+    An ancestor reached along more than one path is only described 
+    the first time it is reached.
     """
 
-    if type (item) == str:
+    if isinstance (item, str):
         orig_item = item
-        item = obj.traverse (item)
+        item = lookup (item)
         if item is None:
-            print "FATAL: Item does not exist."
+            print ("FATAL: Item does not exist.")
             return
         elif item.get_name () != orig_item: # Alias
-            print orig_item, "is an alias for", item.get_name ()
+            print (orig_item, "is an alias for", item.get_name ())
+
+    seen = set ([item])
+    stack = [(item, parent, 0) for parent in reversed (item.get_parents ())]
 
-    for parent in item.get_parents():
-        print " " * recur_depth + item.get_name (), \
-            "is a kind of", parent.get_name() + ";"
+    while stack:
+        term, parent, depth = stack.pop ()
+        print (" " * depth + term.get_name (),
+               "is a kind of", parent.get_name () + ";")
 
-        what_is (parent, recur_depth + 1)
+        if parent not in seen:
+            seen.add (parent)
+            for grandparent in reversed (parent.get_parents ()):
+                stack.append ((parent, grandparent, depth + 1))
 
 def make_alias (alias, true_name):
     """Create an alias.
@@ -236,96 +377,138 @@ def make_alias (alias, true_name):
     When an alias is created, the tree will be updated to replace any 
     names matching the alias with the real name.
 
-    TODO: ensure cyclic aliases cannot be made.
+    Aliases always map straight to a real name, never to another 
+    alias, so that resolving one takes a single lookup.
     """
 
-    # Check to see if the true name is in itself an alias.
-    item = obj.traverse (true_name)
+    if alias in aliases:
+        return
 
-    if item is not None:
-        true_name = item.get_name ()
+    alias = sys.intern (alias)
+    true_name = sys.intern (resolve_alias (true_name))
 
-    if alias not in aliases.keys ():
-        aliases[alias] = true_name
+    if true_name == alias:
+        print ("FATAL: Alias", alias, "would refer to itself.")
+        return
+    elif alias == obj.name:
+        print ("FATAL: The root term", alias, "cannot be an alias.")
+        return
+
+    # Existing aliases for this alias now need to skip over it.
+    for other in aliases:
+        if aliases[other] == alias:
+            aliases[other] = true_name
+
+    aliases[alias] = true_name
+
+def resolve_alias (name):
+    """Follow aliases from name to the real name they stand for."""
+    seen = set ()
+
+    while name in aliases and name not in seen:
+        seen.add (name)
+        name = aliases[name]
+
+    return name
+
+def update_names ():
+    """Replace all term names that are aliases with their true names.
+
+    Only alias names can need replacing, so rather than walking the 
+    whole tree this checks each alias against the name index.  This 
+    relies on the index holding every term under its own name: new 
+    terms are always created under real names, and are never given a 
+    name that another term already has.
+    """
+    for alias in aliases:
+        term = name_index.get (alias)
+        if term is None:
+            continue
+
+        existing = name_index.get (aliases[alias])
+        if existing is None:
+            term.rename (aliases[alias])
+        else:
+            existing.absorb (term)
 
 def save_aliases (f):
     """Save aliases to the open file."""
-    for alias in aliases.keys ():
-        print >> f, alias, "is an alias for", aliases[alias]
-
-def load_aliases (f):
-    """Load aliases from the open file."""
-    f.seek (0)
+    lines = [alias + " is an alias for " + aliases[alias] + "\n"
+             for alias in aliases]
 
-    for line in f.readlines ():
-        aa = aare.match (line)
-        if aa:
-            make_alias (aa.group ('alias'), aa.group ('true_name'))
-            obj.update_names () 
+    f.write ("".join (lines))
 
 def get_terms ():
-    """Return a list of all terms the knowledge base knows about."""
-
-    terms = [t.name for t in obj.list_reduce ()]
+    """Return a sorted list of all terms the knowledge base knows 
+    about.
+    """
 
-    for alias in aliases.keys ():
-        if alias not in terms:
-            terms.append (alias)
+    # Every term is in the name index, so there is no need to walk the 
+    # tree to find them.
+    terms = set (name_index)
+    terms.update (aliases)
 
-    return terms
+    return sorted (terms)
 
 ### MAIN CODE ###
 
 running = True
 
-# Regexes used in command parsing.
+# Regex used in command parsing.  Each kind of command is one 
+# alternative, so a line only needs matching once; the name of the 
+# outer group that matched says which kind it was.
 
-kore = re.compile ('(?P<x>.+) is a kind of (?P<y>.+)')
-wire = re.compile ('what is (?P<item>.+)\?')
-aare = re.compile ('(?P<alias>.+) is an alias for (?P<true_name>.+)')
+cmdre = re.compile (r'(?P<kind_of>(?P<x>.+) is a kind of (?P<y>.+))'
+                    r'|(?P<alias_for>(?P<alias>.+) is an alias for '
+                    r'(?P<true_name>.+))'
+                    r'|(?P<what_is>what is (?P<item>.+)\?)')
 
 while running:
-    print 
-    print "Type X is a kind of Y to create a relationship."
-    print "Type X is an alias for Y to create an alias."
-    print "Type what is Y? to query relationships."
-    print "Type quit to quit, save to save knowledge and load to load it."
-    print
-    print "I know about:"
-    print ", ".join (get_terms ())
-    print
-
-    command = raw_input ("> ")
-
-    km = kore.match (command)
-    if km:
-        add_kind_of (km.group ('x'), km.group ('y'))
-        obj.print_tree ()
-
-    aa = aare.match (command)
-    if aa:
-        make_alias (aa.group ('alias'), aa.group ('true_name'))
-        obj.update_names ()
-        obj.print_tree ()
-
-    wi = wire.match (command)
-    if wi:
-        what_is (wi.group ('item'))
+    print ()
+    print ("Type X is a kind of Y to create a relationship.")
+    print ("Type X is an alias for Y to create an alias.")
+    print ("Type what is Y? to query relationships.")
+    print ("Type quit to quit, save to save knowledge and load to load it.")
+    print ()
+    print ("I know about:")
+    print (", ".join (get_terms ()))
+    print ()
+
+    command = input ("> ")
+    cm = cmdre.match (command)
+    form = cm.lastgroup if cm else None
 
     if command == "quit":
         running = False
     elif command == "save":
+        prune_pending ()
         with open ("knowledge.db", "w") as f:
             obj.save_tree (f)
             save_aliases (f)
     elif command == "load":
         with open ("knowledge.db", "r") as f:
-            for line in f.readlines ():
-                km = kore.match (line)
-                if km:
-                    add_kind_of (km.group ('x'), km.group ('y'))
-            load_aliases (f)
-
-        obj.prune_tree ()
+            for line in f:
+                lm = cmdre.match (line)
+                if lm is None:
+                    continue
+                elif lm.lastgroup == "kind_of":
+                    add_kind_of (lm.group ('x'), lm.group ('y'))
+                elif lm.lastgroup == "alias_for":
+                    make_alias (lm.group ('alias'), lm.group ('true_name'))
+
+        update_names ()
+        prune_pending ()
+        obj.print_tree ()
+        print (aliases)
+    elif form == "kind_of":
+        add_kind_of (cm.group ('x'), cm.group ('y'))
+        prune_pending ()
+        obj.print_tree ()
+    elif form == "alias_for":
+        make_alias (cm.group ('alias'), cm.group ('true_name'))
+        update_names ()
+        prune_pending ()
         obj.print_tree ()
-        print aliases
+    elif form == "what_is":
+        prune_pending ()
+        what_is (cm.group ('item'))